@@ -2,65 +2,143 @@
 
 import numpy as np
 import pandas as pd
-from scipy.stats import ttest_ind
+from scipy.special import stdtr
 
-from descriptive_stats import process_cycles, categorize_amalgam
+from descriptive_stats import process_cycles, categorize_amalgam_vec
 
 
 
+def _from_codes(
+    codes: np.ndarray, missing: np.ndarray, categories: list[str], ordered: bool = False
+) -> pd.Categorical:
+    """Build a Categorical from integer codes, marking ``missing`` rows as NaN."""
+    codes = np.where(missing, -1, codes).astype(np.int8)
+    return pd.Categorical.from_codes(codes, categories=categories, ordered=ordered)
+
+
 def prepare_groups(df: pd.DataFrame) -> pd.DataFrame:
     df = df.copy()
-    df["Amalgam Group"] = df["amalgam_surfaces"].apply(categorize_amalgam)
-    df["Gender"] = df["RIAGENDR"].replace({1: "Male", 2: "Female"})
-    df["Race"] = df["RIDRETH1"].replace({
-        1: "Mexican American",
-        2: "Other Hispanic",
-        3: "Non-Hispanic White",
-        4: "Non-Hispanic Black",
-        5: "Other Race/Multi-Racial",
-    })
-    df["AgeGroup"] = pd.cut(
-        df["RIDAGEYR"],
-        bins=[0, 19, 39, 59, np.inf],
-        labels=["0–19", "20–39", "40–59", "60+"],
-        right=True,
+    df["Amalgam Group"] = categorize_amalgam_vec(df["amalgam_surfaces"].to_numpy())
+    gender = df["RIAGENDR"].to_numpy(dtype=np.float64)
+    df["Gender"] = _from_codes(gender - 1, ~np.isin(gender, [1, 2]), ["Male", "Female"])
+    race = df["RIDRETH1"].to_numpy(dtype=np.float64)
+    df["Race"] = _from_codes(
+        race - 1,
+        ~np.isin(race, [1, 2, 3, 4, 5]),
+        [
+            "Mexican American",
+            "Other Hispanic",
+            "Non-Hispanic White",
+            "Non-Hispanic Black",
+            "Other Race/Multi-Racial",
+        ],
+    )
+    # Right-closed bins (0, 19], (19, 39], (39, 59], (59, inf) as with pd.cut
+    age = df["RIDAGEYR"].to_numpy(dtype=np.float64)
+    df["AgeGroup"] = _from_codes(
+        np.searchsorted([0, 19, 39, 59], age, side="left") - 1,
+        np.isnan(age) | (age <= 0),
+        ["0–19", "20–39", "40–59", "60+"],
+        ordered=True,
     )
     return df
 
 
+def welch_ttest(n1, m1, v1, n2, m2, v2):
+    """Welch's t-test from group sizes, means and sample variances.
+
+    Equivalent to ``ttest_ind(..., equal_var=False)`` without the per-call
+    input validation; works elementwise on scalars or arrays. Returns the
+    t-statistic and the two-sided p-value.
+    """
+    se1 = v1 / n1
+    se2 = v2 / n2
+    stat = (m1 - m2) / np.sqrt(se1 + se2)
+    # Welch-Satterthwaite degrees of freedom
+    dof = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    return stat, 2 * stdtr(dof, -np.abs(stat))
+
+
+def nan_column_stats(values: np.ndarray):
+    """Per-column count, mean and sample variance of a 2-D array, ignoring NaNs."""
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, values, 0.0).sum(axis=0) / n
+        var = (np.where(valid, values - mean, 0.0) ** 2).sum(axis=0) / (n - 1)
+    return n, mean, var
+
+
 def run_t_tests(df: pd.DataFrame) -> pd.DataFrame:
     markers = ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]
     comparisons = [("None", "Low"), ("None", "Medium"), ("None", "High")]
     strata_vars = ["Gender", "Race", "AgeGroup"]
+    labels = [f"{var1} vs {var2}" for var1, var2 in comparisons]
+
+    # All markers as one (rows x markers) array with a per-column NaN mask
+    values = df[markers].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+
+    frames = []
+    for strata in strata_vars:
+        indices = df.groupby(["Cycle", strata, "Amalgam Group"], sort=False, observed=True).indices
+        if not indices:
+            continue
+        rows = np.concatenate(list(indices.values()))
+        sizes = np.array([len(idx) for idx in indices.values()])
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        # Count, mean and variance of every marker for every cell in one pass each
+        ok = valid[rows]
+        vals = np.where(ok, values[rows], 0.0)
+        n = np.add.reduceat(ok, starts, axis=0, dtype=np.int64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.add.reduceat(vals, starts, axis=0) / n
+            dev = np.where(ok, vals - np.repeat(mean, sizes, axis=0), 0.0)
+            var = np.add.reduceat(dev ** 2, starts, axis=0) / (n - 1)
+        cells = pd.MultiIndex.from_tuples(list(indices), names=["Cycle", "Group", "Amalgam Group"])
+        stats = pd.concat(
+            {
+                "n": pd.DataFrame(n, index=cells, columns=markers),
+                "mean": pd.DataFrame(mean, index=cells, columns=markers),
+                "var": pd.DataFrame(var, index=cells, columns=markers),
+            },
+            axis=1,
+        ).unstack("Amalgam Group")
+        observed = set(stats.columns.get_level_values("Amalgam Group"))
+        parts = ("n", "mean", "var")
 
-    results = []
-    for cycle, df_cycle in df.groupby("Cycle"):
-        for strata in strata_vars:
-            for strata_value, df_sub in df_cycle.groupby(strata):
-                if pd.isna(strata_value):
-                    continue
-                for var1, var2 in comparisons:
-                    g1 = df_sub[df_sub["Amalgam Group"] == var1]
-                    g2 = df_sub[df_sub["Amalgam Group"] == var2]
-                    for marker in markers:
-                        g1_vals = g1[marker].dropna()
-                        g2_vals = g2[marker].dropna()
-                        if len(g1_vals) < 10 or len(g2_vals) < 10:
-                            continue
-                        stat, pval = ttest_ind(g1_vals, g2_vals, equal_var=False)
-                        results.append({
-                            "Cycle": cycle,
-                            "Strata": strata,
-                            "Group": strata_value,
-                            "Marker": marker,
-                            "Comparison": f"{var1} vs {var2}",
-                            "Group1 n": len(g1_vals),
-                            "Group2 n": len(g2_vals),
-                            "t-stat": round(stat, 3),
-                            "p-value": round(pval, 5),
-                            "Significant": pval < 0.05,
-                        })
-    return pd.DataFrame(results)
+        for (var1, var2), label in zip(comparisons, labels):
+            if var1 not in observed or var2 not in observed:
+                continue
+            # (strata cells x markers) arrays for each side of the comparison
+            n1, m1, v1 = (stats[s].xs(var1, axis=1, level="Amalgam Group")[markers].to_numpy() for s in parts)
+            n2, m2, v2 = (stats[s].xs(var2, axis=1, level="Amalgam Group")[markers].to_numpy() for s in parts)
+            keep = (n1 >= 10) & (n2 >= 10)
+            cell_idx, marker_idx = np.nonzero(keep)
+            stat, pval = welch_ttest(n1[keep], m1[keep], v1[keep], n2[keep], m2[keep], v2[keep])
+            frame = stats.index[cell_idx].to_frame(index=False, name=["Cycle", "Group"])
+            frame.insert(1, "Strata", strata)
+            frame["Marker"] = np.asarray(markers)[marker_idx]
+            frame["Comparison"] = label
+            frame["Group1 n"] = n1[keep].astype(int)
+            frame["Group2 n"] = n2[keep].astype(int)
+            frame["t-stat"] = np.round(stat, 3)
+            frame["p-value"] = np.round(pval, 5)
+            frame["Significant"] = pval < 0.05
+            frames.append(frame)
+    if not frames:
+        return pd.DataFrame()
+    results = pd.concat(frames, ignore_index=True)
+    results["Group"] = results["Group"].astype(str)
+    order = {
+        "Strata": pd.CategoricalDtype(strata_vars, ordered=True),
+        "Comparison": pd.CategoricalDtype(labels, ordered=True),
+        "Marker": pd.CategoricalDtype(markers, ordered=True),
+    }
+    return results.sort_values(
+        ["Cycle", "Strata", "Group", "Comparison", "Marker"],
+        key=lambda col: col.astype(order[col.name]) if col.name in order else col,
+    ).reset_index(drop=True)
 
 
 def main():
@@ -69,6 +147,8 @@ def main():
     ttest_df = run_t_tests(combined)
     # Save t-test results to CSV
     ttest_df.to_csv("ttest_results.csv", index=False)
+    # Keep the prepared groups (as Categoricals) for box_plots.py
+    combined.reset_index(drop=True).to_feather("combined_prepared.feather")
     print(ttest_df.head())
 
 
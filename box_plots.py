@@ -2,10 +2,10 @@ import os
 import re
 
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
 
-from descriptive_stats import categorize_amalgam
-from analysis import prepare_groups
+matplotlib.use("Agg")  # file output only; skip GUI backend setup
+import matplotlib.pyplot as plt
 
 
 def slugify(value: str) -> str:
@@ -14,10 +14,12 @@ def slugify(value: str) -> str:
 
 
 def main():
-    df = pd.read_csv("combined_dataset.csv")
-    df["Amalgam Group"] = df["amalgam_surfaces"].apply(categorize_amalgam)
-    # Ensure grouping columns are present for subsetting
-    df = prepare_groups(df)
+    try:
+        # Written by analysis.py with the grouping columns already prepared
+        df = pd.read_feather("combined_prepared.feather")
+    except FileNotFoundError:
+        print("combined_prepared.feather not found, run analysis.py first")
+        return
     out_dir = "output"
     os.makedirs(out_dir, exist_ok=True)
 
@@ -32,6 +34,17 @@ def main():
         print("No significant comparisons found")
         return
 
+    # Row positions of each (Cycle, strata value) cell, looked up per plot
+    # instead of rescanning the full frame for every significant row
+    strata_rows = {
+        strata: df.groupby(["Cycle", strata], observed=True, sort=False).indices
+        for strata in ttest_sig["Strata"].unique()
+    }
+
+    # One figure reused for every plot; creating and tearing down a figure
+    # per plot dominates the runtime for small box plots. The default size
+    # matches the former plots, whose boxplot(by=...) drew on a figure of its own
+    fig, ax = plt.subplots()
     for _, row in ttest_sig.iterrows():
         cycle = row["Cycle"]
         strata = row["Strata"]
@@ -39,23 +52,26 @@ def main():
         marker = row["Marker"]
         comp_groups = row["Comparison"].split(" vs ")
 
-        df_sub = df[(df["Cycle"] == cycle) & (df[strata] == group_val)]
-        df_box = df_sub[df_sub["Amalgam Group"].isin(comp_groups)][
-            ["Amalgam Group", marker]
-        ].dropna()
+        rows = strata_rows[strata].get((cycle, group_val))
+        if rows is None:
+            continue
+        df_box = df[["Amalgam Group", marker]].iloc[rows]
+        df_box = df_box[df_box["Amalgam Group"].isin(comp_groups)].dropna()
         if df_box.empty:
             continue
+        # Only the two compared groups, drawn alphabetically as before
+        df_box["Amalgam Group"] = df_box["Amalgam Group"].astype(str)
 
-        plt.figure(figsize=(8, 6))
-        df_box.boxplot(column=marker, by="Amalgam Group")
+        ax.clear()
+        df_box.boxplot(column=marker, by="Amalgam Group", ax=ax)
         title = (
             f"{marker} - {cycle} - {strata}: {group_val} ({row['Comparison']})"
         )
-        plt.title(title)
-        plt.suptitle("")
-        plt.xlabel("Amalgam Group")
-        plt.ylabel(marker)
-        plt.tight_layout()
+        ax.set_title(title)
+        fig.suptitle("")
+        ax.set_xlabel("Amalgam Group")
+        ax.set_ylabel(marker)
+        fig.tight_layout()
         fname_parts = [
             "sig_boxplot",
             slugify(marker),
@@ -65,8 +81,8 @@ def main():
             slugify(row["Comparison"]),
         ]
         fname = "_".join(fname_parts) + ".png"
-        plt.savefig(os.path.join(out_dir, fname))
-        plt.close("all")
+        fig.savefig(os.path.join(out_dir, fname))
+    plt.close(fig)
 
 
 if __name__ == "__main__":
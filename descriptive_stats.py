@@ -1,7 +1,10 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import pyreadstat
+from numba import njit, prange
 
 CBC_DEMO_DENTAL_FILES = {
     # (CBC, Demographics, Dental, CRP, Mercury)
@@ -18,34 +21,67 @@ CBC_DEMO_DENTAL_FILES = {
 
 REQUIRED_LABELS = ["CBC", "Demographics", "Dental", "CRP", "Mercury"]
 
+# Only a handful of distinct cycles, so group and merge on categorical codes
+CYCLE_DTYPE = pd.CategoricalDtype(list(CBC_DEMO_DENTAL_FILES))
+
+AMALGAM_GROUPS = ["None", "Low", "Medium", "High"]
+
+FLOAT32_COLUMNS = [
+    "WBC", "Neutro", "Lympho", "Mono", "Platelets",
+    "NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury",
+    "WTMEC2YR", "LBXTHG", "LBXBPB", "LBXBCD",
+]
+
+# Parquet copies of parsed cycles, stored under the data directory
+CACHE_DIR = "_cache"
+
 
 def _cycles_with_all_files(log_path: str = "download_log.csv") -> set[str]:
     """Return cycles that successfully downloaded all required files."""
     if not os.path.exists(log_path):
         return set(CBC_DEMO_DENTAL_FILES.keys())
     log_df = pd.read_csv(log_path)
-    valid = set()
-    for cycle, grp in log_df.groupby("Cycle"):
-        statuses = {
-            label: grp[grp["Label"] == label]["Status"].iloc[0]
-            for label in grp["Label"].unique()
-        }
-        if all(statuses.get(lbl) == "success" for lbl in REQUIRED_LABELS):
-            valid.add(cycle)
-    return valid
+    # Cycle x Label table of the first logged status of each file
+    status = log_df.drop_duplicates(["Cycle", "Label"]).pivot(
+        index="Cycle", columns="Label", values="Status"
+    )
+    complete = (status.reindex(columns=REQUIRED_LABELS) == "success").all(axis=1)
+    return set(status.index[complete])
 
 
 def count_amalgam_surfaces(df: pd.DataFrame) -> pd.DataFrame:
     cols = [c for c in df.columns if c.startswith("OHX") and c.endswith(("TC", "FS", "FT"))]
-    df["amalgam_surfaces"] = (df[cols] == 2).sum(axis=1)
-    return df[["SEQN", "amalgam_surfaces"]]
+    # Compare on one contiguous array; NaN (not examined) never equals 2
+    surfaces = (df[cols].to_numpy() == 2).sum(axis=1, dtype=np.uint16)
+    return pd.DataFrame({"SEQN": df["SEQN"], "amalgam_surfaces": surfaces})
+
+
+@njit(cache=True)
+def _wstats(x: np.ndarray, w: np.ndarray):
+    """Single-pass weighted mean and variance over the non-NaN, positive-weight values."""
+    total_weight = 0.0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(x.size):
+        xi = x[i]
+        wi = w[i]
+        if xi != xi or not wi > 0.0:
+            continue
+        total_weight += wi
+        delta = xi - mean
+        mean += wi / total_weight * delta
+        m2 += wi * delta * (xi - mean)
+    if total_weight == 0.0:
+        return np.nan, np.nan, 0.0
+    return mean, m2 / total_weight, total_weight
 
 
 def weighted_stats(series: pd.Series, weights: pd.Series):
-    try:
-        mean = np.average(series, weights=weights)
-        variance = np.average((series - mean) ** 2, weights=weights)
-    except Exception:
+    mean, variance, total_weight = _wstats(
+        np.asarray(series, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+    )
+    if total_weight == 0.0:
+        # No usable weights: fall back to the unweighted estimates
         mean = series.mean()
         variance = series.var()
     std = np.sqrt(variance)
@@ -53,83 +89,274 @@ def weighted_stats(series: pd.Series, weights: pd.Series):
     return round(mean, 3), round(std, 3), round(mean - 1.96 * se, 3), round(mean + 1.96 * se, 3)
 
 
+def weighted_stats_matrix(values: np.ndarray, weights: np.ndarray):
+    """Column-wise :func:`weighted_stats` for a (rows x markers) array.
+
+    Each column only uses rows where both the value and the weight are present.
+    Returns rounded mean, SD, CI bounds and the sample size as per-column arrays.
+    """
+    mask = ~np.isnan(values) & ~np.isnan(weights)[:, None]
+    n = mask.sum(axis=0)
+    x = np.where(mask, values, 0.0)
+    w = np.where(mask, weights[:, None], 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total_weight = w.sum(axis=0)
+        mean = (w * x).sum(axis=0) / total_weight
+        variance = (w * (x - mean) ** 2).sum(axis=0) / total_weight
+        # Columns without usable weights fall back to the unweighted estimates
+        unweighted = total_weight == 0
+        if unweighted.any():
+            plain_mean = x.sum(axis=0) / n
+            plain_var = (np.where(mask, x - plain_mean, 0.0) ** 2).sum(axis=0) / (n - 1)
+            mean = np.where(unweighted, plain_mean, mean)
+            variance = np.where(unweighted, plain_var, variance)
+        std = np.sqrt(variance)
+        se = std / np.sqrt(n)
+    return (
+        np.round(mean, 3),
+        np.round(std, 3),
+        np.round(mean - 1.96 * se, 3),
+        np.round(mean + 1.96 * se, 3),
+        n,
+    )
+
+
+@njit(parallel=True, cache=True)
+def _grouped_wstats(values: np.ndarray, weights: np.ndarray, offsets: np.ndarray):
+    """Weighted mean and variance of each ``offsets[g]:offsets[g + 1]`` run.
+
+    Runs whose weights sum to zero fall back to the unweighted mean and
+    sample variance.
+    """
+    n_groups = offsets.size - 1
+    mean = np.empty(n_groups)
+    var = np.empty(n_groups)
+    for g in prange(n_groups):
+        start = offsets[g]
+        stop = offsets[g + 1]
+        sw = 0.0
+        swx = 0.0
+        for i in range(start, stop):
+            sw += weights[i]
+            swx += weights[i] * values[i]
+        if sw != 0.0:
+            m = swx / sw
+            ss = 0.0
+            for i in range(start, stop):
+                d = values[i] - m
+                ss += weights[i] * d * d
+            mean[g] = m
+            var[g] = ss / sw
+        else:
+            count = stop - start
+            sx = 0.0
+            for i in range(start, stop):
+                sx += values[i]
+            m = sx / count
+            ss = 0.0
+            for i in range(start, stop):
+                d = values[i] - m
+                ss += d * d
+            mean[g] = m
+            var[g] = ss / (count - 1) if count > 1 else np.nan
+    return mean, var
+
+
+def grouped_weighted_stats(df: pd.DataFrame, keys: list[str], markers: list[str]) -> pd.DataFrame:
+    """:func:`weighted_stats` for every (``keys``..., Marker) cell in one pass.
+
+    Rows with a missing marker value or weight are dropped per marker, as the
+    per-cell ``dropna`` did. Returns one row per non-empty cell.
+    """
+    long = df.melt(
+        id_vars=[*keys, "WTMEC2YR"], value_vars=markers, var_name="Marker", value_name="Value"
+    ).dropna(subset=["Value", "WTMEC2YR"])
+    long["Marker"] = pd.Categorical(long["Marker"], categories=markers)
+    grouped = long.groupby([*keys, "Marker"], observed=True)
+    # Lay every cell out contiguously so the kernel works on plain offsets
+    group_id = grouped.ngroup().to_numpy()
+    order = np.argsort(group_id, kind="stable")
+    n = grouped.size()
+    offsets = np.zeros(len(n) + 1, dtype=np.int64)
+    np.cumsum(n.to_numpy(), out=offsets[1:])
+    mean, variance = _grouped_wstats(
+        long["Value"].to_numpy(dtype=np.float64)[order],
+        long["WTMEC2YR"].to_numpy(dtype=np.float64)[order],
+        offsets,
+    )
+    std = np.sqrt(variance)
+    se = std / np.sqrt(n.to_numpy())
+    return pd.DataFrame({
+        "Mean": np.round(mean, 3),
+        "SD": np.round(std, 3),
+        "CI_Low": np.round(mean - 1.96 * se, 3),
+        "CI_High": np.round(mean + 1.96 * se, 3),
+        "Sample Size": n,
+    }, index=n.index).reset_index()
+
+
+def is_cache_fresh(cache_path: str, sources: list[str]) -> bool:
+    """Return True if ``cache_path`` exists and is newer than every source file."""
+    if not os.path.exists(cache_path):
+        return False
+    cache_mtime = os.path.getmtime(cache_path)
+    return all(os.path.exists(src) and os.path.getmtime(src) < cache_mtime for src in sources)
+
+
+def write_cache(df: pd.DataFrame, cache_path: str) -> None:
+    """Write ``df`` to ``cache_path`` as Parquet via a temporary file.
+
+    An interrupted write then never leaves a truncated file behind that
+    :func:`is_cache_fresh` would take for a valid cache.
+    """
+    tmp_path = cache_path + ".part"
+    df.to_parquet(tmp_path, compression="zstd")
+    os.replace(tmp_path, cache_path)
+
+
+def _merge_cycle(cycle: str, files: tuple[str, ...], data_dir: str) -> pd.DataFrame:
+    """Read the XPT files of one cycle and derive the inflammation markers."""
+    cbc_file, demo_file, dental_file, crp_file, mercury_file = files
+    cbc = pyreadstat.read_xport(os.path.join(data_dir, cbc_file))[0]
+    demo = pyreadstat.read_xport(os.path.join(data_dir, demo_file))[0]
+    dental = pyreadstat.read_xport(os.path.join(data_dir, dental_file))[0]
+    crp = pyreadstat.read_xport(os.path.join(data_dir, crp_file))[0]
+    mercury = pyreadstat.read_xport(os.path.join(data_dir, mercury_file))[0]
+    dental = count_amalgam_surfaces(dental)
+
+    df = (
+        demo.merge(cbc, on="SEQN")
+        .merge(crp, on="SEQN", how="left")
+        .merge(mercury, on="SEQN", how="left")
+        .merge(dental, on="SEQN", how="left")
+    )
+    df["Cycle"] = cycle
+
+    df["WBC"] = df.get("LBXWBCSI")
+    df["Neutro"] = df["WBC"] * df.get("LBXNEPCT", 0) / 100
+    df["Lympho"] = df["WBC"] * df.get("LBXLYPCT", 0) / 100
+    df["Mono"] = df["WBC"] * df.get("LBXMOPCT", 0) / 100
+    df["Platelets"] = df.get("LBXPLTSI")
+    df["CRP"] = df.get("LBXCRP") if "LBXCRP" in df.columns else df.get("LBXHSCRP")
+    df["BloodMercury"] = df.get("LBXTHG")
+
+    # NLR, MLR, PLR and SII share the lymphocyte denominator: one fused divide
+    neutro = df["Neutro"].to_numpy(dtype=np.float64)
+    platelets = df["Platelets"].to_numpy(dtype=np.float64)
+    ratios = np.column_stack(
+        [neutro, df["Mono"].to_numpy(dtype=np.float64), platelets, neutro * platelets]
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(ratios, df["Lympho"].to_numpy(dtype=np.float64)[:, None], out=ratios)
+    df[["NLR", "MLR", "PLR", "SII"]] = ratios
+
+    # Lab values and weights fit comfortably in float32; demographic codes in
+    # small integers (left as float when a value is missing)
+    for col in FLOAT32_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype(np.float32)
+    for col in ["RIAGENDR", "RIDRETH1", "RIDAGEYR"]:
+        if col in df:
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+
+def _process_one_cycle(cycle: str, files: tuple[str, ...], data_dir: str):
+    """Load one cycle, from its Parquet cache when it is newer than the XPT files.
+
+    Returns ``(df, summary)`` or ``None`` if the cycle could not be read.
+    """
+    cache_path = os.path.join(data_dir, CACHE_DIR, f"{cycle}.parquet")
+    try:
+        if is_cache_fresh(cache_path, [os.path.join(data_dir, f) for f in files]):
+            df = pd.read_parquet(cache_path)
+        else:
+            df = _merge_cycle(cycle, files, data_dir)
+            write_cache(df, cache_path)
+
+        markers = np.array(["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"])
+        mean, sd, lo, hi, n = weighted_stats_matrix(
+            df[markers].to_numpy(dtype=np.float64), df["WTMEC2YR"].to_numpy(dtype=np.float64)
+        )
+        present = n > 0
+        summary = pd.DataFrame({
+            "Cycle": cycle,
+            "Marker": markers[present],
+            "Mean": mean[present],
+            "SD": sd[present],
+            "CI_Low": lo[present],
+            "CI_High": hi[present],
+            "Sample Size": n[present],
+        })
+    except Exception as exc:
+        print(f"Skipped {cycle}: {exc}")
+        return None
+    return df, summary
+
+
 def process_cycles(data_dir: str = "nhanes_data"):
     df_all: list[pd.DataFrame] = []
-    all_summaries: list[dict] = []
+    all_summaries: list[pd.DataFrame] = []
     valid_cycles = _cycles_with_all_files()
-    for cycle, (
-        cbc_file,
-        demo_file,
-        dental_file,
-        crp_file,
-        mercury_file,
-    ) in CBC_DEMO_DENTAL_FILES.items():
+    jobs: dict[str, tuple[str, ...]] = {}
+    for cycle, files in CBC_DEMO_DENTAL_FILES.items():
         if cycle not in valid_cycles:
             print(f"Skipped {cycle}: missing required files (see download_log.csv)")
             continue
-        try:
-            cbc = pyreadstat.read_xport(os.path.join(data_dir, cbc_file))[0]
-            demo = pyreadstat.read_xport(os.path.join(data_dir, demo_file))[0]
-            dental = pyreadstat.read_xport(os.path.join(data_dir, dental_file))[0]
-            crp = pyreadstat.read_xport(os.path.join(data_dir, crp_file))[0]
-            mercury = pyreadstat.read_xport(os.path.join(data_dir, mercury_file))[0]
-            dental = count_amalgam_surfaces(dental)
-
-            df = (
-                demo.merge(cbc, on="SEQN")
-                .merge(crp, on="SEQN", how="left")
-                .merge(mercury, on="SEQN", how="left")
-                .merge(dental, on="SEQN", how="left")
-            )
-            df["Cycle"] = cycle
-
-            df["WBC"] = df.get("LBXWBCSI")
-            df["Neutro"] = df["WBC"] * df.get("LBXNEPCT", 0) / 100
-            df["Lympho"] = df["WBC"] * df.get("LBXLYPCT", 0) / 100
-            df["Mono"] = df["WBC"] * df.get("LBXMOPCT", 0) / 100
-            df["Platelets"] = df.get("LBXPLTSI")
-            df["CRP"] = df.get("LBXCRP") if "LBXCRP" in df.columns else df.get("LBXHSCRP")
-            df["BloodMercury"] = df.get("LBXTHG")
-
-            df["NLR"] = df["Neutro"] / df["Lympho"]
-            df["MLR"] = df["Mono"] / df["Lympho"]
-            df["PLR"] = df["Platelets"] / df["Lympho"]
-            df["SII"] = (df["Neutro"] * df["Platelets"]) / df["Lympho"]
-
-            df_all.append(df)
-
-            for marker in ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]:
-                sub = df[[marker, "WTMEC2YR"]].dropna()
-                if sub.empty:
+        jobs[cycle] = files
+
+    # Reuse the combined output when no source file or the download log changed
+    cache_dir = os.path.join(data_dir, CACHE_DIR)
+    combined_path = os.path.join(cache_dir, "combined.parquet")
+    summary_path = os.path.join(cache_dir, "summary.parquet")
+    sources = [os.path.join(data_dir, f) for files in jobs.values() for f in files]
+    if os.path.exists("download_log.csv"):
+        sources.append("download_log.csv")
+    if jobs and all(is_cache_fresh(path, sources) for path in (combined_path, summary_path)):
+        combined_df = pd.read_parquet(combined_path).astype({"Cycle": CYCLE_DTYPE})
+        return combined_df, pd.read_parquet(summary_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    failed = False
+    if jobs:
+        # XPT parsing is CPU-bound and independent per cycle
+        workers = min(len(jobs), 10, os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_process_one_cycle, cycle, files, data_dir)
+                for cycle, files in jobs.items()
+            ]
+            for future in futures:
+                result = future.result()
+                if result is None:
+                    failed = True
                     continue
-                m, sd, lo, hi = weighted_stats(sub[marker], sub["WTMEC2YR"])
-                all_summaries.append({
-                    "Cycle": cycle,
-                    "Marker": marker,
-                    "Mean": m,
-                    "SD": sd,
-                    "CI_Low": lo,
-                    "CI_High": hi,
-                    "Sample Size": len(sub),
-                })
-        except Exception as exc:
-            print(f"Skipped {cycle}: {exc}")
+                df, summary = result
+                df_all.append(df)
+                all_summaries.append(summary)
 
     combined_df = pd.concat(df_all, ignore_index=True) if df_all else pd.DataFrame()
-    summary_df = pd.DataFrame(all_summaries)
+    summary_df = pd.concat(all_summaries, ignore_index=True) if all_summaries else pd.DataFrame()
+    if df_all:
+        combined_df["Cycle"] = combined_df["Cycle"].astype(CYCLE_DTYPE)
+        # A fresh cache would hide a failed cycle on every later run
+        if not failed:
+            write_cache(combined_df, combined_path)
+            write_cache(summary_df, summary_path)
     return combined_df, summary_df
 
 
+def categorize_amalgam_vec(surfaces: np.ndarray) -> pd.Categorical:
+    """Categorize an array of amalgam surface counts in one vectorized pass."""
+    surfaces = np.asarray(surfaces, dtype=np.float64)
+    # 0 -> None, (0, 5] -> Low, (5, 10] -> Medium, > 10 -> High
+    codes = np.searchsorted([0, 5, 10], surfaces, side="left")
+    codes = np.where(np.isnan(surfaces), -1, codes)
+    return pd.Categorical.from_codes(codes, categories=AMALGAM_GROUPS, ordered=True)
+
+
 def categorize_amalgam(surfaces: float):
-    if pd.isna(surfaces):
-        return np.nan
-    if surfaces == 0:
-        return "None"
-    if surfaces <= 5:
-        return "Low"
-    if surfaces <= 10:
-        return "Medium"
-    return "High"
+    return categorize_amalgam_vec([surfaces])[0]
 
 
 def compute_demographic_stats(df: pd.DataFrame) -> pd.DataFrame:
@@ -142,29 +369,40 @@ def compute_demographic_stats(df: pd.DataFrame) -> pd.DataFrame:
     markers = ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]
     demo_vars = ["Gender", "Race", "AgeGroup"]
 
-    results = []
-    for cycle, df_cycle in df.groupby("Cycle"):
-        for demo in demo_vars:
-            for group_val, df_sub in df_cycle.groupby(demo):
-                if pd.isna(group_val):
+    columns: dict[str, list] = {
+        "Cycle": [],
+        "Demographic": [],
+        "Group": [],
+        "Marker": [],
+        "Mean": [],
+        "SD": [],
+        "CI_Low": [],
+        "CI_High": [],
+        "Sample Size": [],
+    }
+    # One (Cycle, group) groupby per demographic instead of regrouping every cycle
+    for demo in demo_vars:
+        for (cycle, group_val), df_sub in df.groupby(["Cycle", demo], observed=True):
+            for marker in markers:
+                sub = df_sub[[marker, "WTMEC2YR"]].dropna()
+                if sub.empty:
                     continue
-                for marker in markers:
-                    sub = df_sub[[marker, "WTMEC2YR"]].dropna()
-                    if sub.empty:
-                        continue
-                    m, sd, lo, hi = weighted_stats(sub[marker], sub["WTMEC2YR"])
-                    results.append({
-                        "Cycle": cycle,
-                        "Demographic": demo,
-                        "Group": group_val,
-                        "Marker": marker,
-                        "Mean": m,
-                        "SD": sd,
-                        "CI_Low": lo,
-                        "CI_High": hi,
-                        "Sample Size": len(sub),
-                    })
-    return pd.DataFrame(results)
+                m, sd, lo, hi = weighted_stats(sub[marker], sub["WTMEC2YR"])
+                for name, value in zip(
+                    columns, (cycle, demo, group_val, marker, m, sd, lo, hi, len(sub))
+                ):
+                    columns[name].append(value)
+    if not columns["Cycle"]:
+        return pd.DataFrame()
+    # Restore the former row order: cycle-major, demographics in demo_vars order
+    # and their groups alphabetically, as the string groupby wrote them
+    order = {"Demographic": demo_vars.index, "Group": str}
+    return pd.DataFrame(columns).sort_values(
+        ["Cycle", "Demographic", "Group"],
+        key=lambda col: col.map(order[col.name]) if col.name in order else col,
+        kind="stable",
+        ignore_index=True,
+    )
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
 
 BASE_URLS = {
     "1999-2000": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/1999/DataFiles/",
@@ -138,44 +141,56 @@ for cycle, cbc_file in CBC_FILES.items():
     if cycle in FILE_SUFFIXES:
         FILE_SUFFIXES[cycle]["CBC"] = cbc_file
 
+def _download_one(session, data_dir, cycle, label, filename):
+    """Download a single file and return its ``download_log.csv`` row."""
+    row = {"Cycle": cycle, "Label": label, "Filename": filename or "", "Status": "missing"}
+    if not filename:
+        print(f"Skipping {cycle} {label}: no file for this cycle")
+        return row
+    url = BASE_URLS[cycle] + filename
+    save_path = os.path.join(data_dir, filename)
+    if os.path.exists(save_path) and os.path.getsize(save_path) > 0:
+        print(f"Already downloaded {label}: {filename}")
+        row["Status"] = "success"
+        return row
+    try:
+        with session.get(url, stream=True, timeout=30) as resp:
+            if resp.status_code == 200:
+                # Stream to a temporary file so an interrupted download is never
+                # mistaken for a cached one on the next run
+                tmp_path = save_path + ".part"
+                with open(tmp_path, "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=1 << 16):
+                        f.write(chunk)
+                os.replace(tmp_path, save_path)
+                print(f"Downloaded {label}: {filename}")
+                row["Status"] = "success"
+            else:
+                print(f"Failed ({resp.status_code}): {filename}")
+                row["Status"] = "failed"
+    except Exception as exc:
+        print(f"Error downloading {filename}: {exc}")
+        row["Status"] = "error"
+    return row
+
+
 def download_all(data_dir="nhanes_data"):
     """Download NHANES XPT files for all cycles."""
     os.makedirs(data_dir, exist_ok=True)
-    log_rows = []
-    for cycle in FILE_SUFFIXES:
-        print(f"\nDownloading files for {cycle}")
-        base_url = BASE_URLS[cycle]
-        for label, filename in FILE_SUFFIXES[cycle].items():
-            if not filename:
-                print(f"Skipping {label}: no file for this cycle")
-                log_rows.append({
-                    "Cycle": cycle,
-                    "Label": label,
-                    "Filename": "",
-                    "Status": "missing",
-                })
-                continue
-            url = base_url + filename
-            save_path = os.path.join(data_dir, filename)
-            try:
-                resp = requests.get(url)
-                if resp.status_code == 200:
-                    with open(save_path, "wb") as f:
-                        f.write(resp.content)
-                    print(f"Downloaded {label}: {filename}")
-                    status = "success"
-                else:
-                    print(f"Failed ({resp.status_code}): {filename}")
-                    status = "failed"
-            except Exception as exc:
-                print(f"Error downloading {filename}: {exc}")
-                status = "error"
-            log_rows.append({
-                "Cycle": cycle,
-                "Label": label,
-                "Filename": filename,
-                "Status": status,
-            })
+    tasks = [
+        (cycle, label, filename)
+        for cycle in FILE_SUFFIXES
+        for label, filename in FILE_SUFFIXES[cycle].items()
+    ]
+    # Keep-alive connections shared by the worker threads
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    with session, ThreadPoolExecutor(max_workers=16) as pool:
+        log_rows = list(
+            pool.map(lambda task: _download_one(session, data_dir, *task), tasks)
+        )
     pd.DataFrame(log_rows).to_csv("download_log.csv", index=False)
 
 if __name__ == "__main__":
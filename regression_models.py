@@ -2,14 +2,34 @@
 
 from __future__ import annotations
 
+import numpy as np
 import pandas as pd
 import statsmodels.api as sm
 from patsy import dmatrix
+from scipy import stats
 
 from descriptive_stats import process_cycles
 
 MARKERS = ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]
 
+# Column dtypes the models rely on, applied once before any fitting
+MODEL_DTYPES = {
+    "amalgam_surfaces": np.float32,
+    "RIDAGEYR": np.float32,
+    "RIAGENDR": np.int8,
+    "RIDRETH1": np.int8,
+    **{marker: np.float32 for marker in MARKERS},
+}
+
+
+def cycle_start_year(cycle: pd.Series) -> pd.Series:
+    """Map survey cycle labels such as ``"1999-2000"`` to their start year.
+
+    Only the distinct labels are parsed; the rows are filled by lookup.
+    """
+    years = {c: int(c[:4]) for c in cycle.unique()}
+    return cycle.map(years).astype(np.int16)
+
 
 def _encode_covariates(df: pd.DataFrame) -> pd.DataFrame:
     """Encode amalgam burden and demographic covariates.
@@ -18,64 +38,117 @@ def _encode_covariates(df: pd.DataFrame) -> pd.DataFrame:
     ----------
     df:
         DataFrame containing columns ``amalgam_surfaces``, ``RIDAGEYR``,
-        ``RIAGENDR`` and ``RIDRETH1``.
+        ``RIAGENDR`` and ``RIDRETH1``, already cast to :data:`MODEL_DTYPES`.
 
     Returns
     -------
     DataFrame with numeric covariates and dummy variables ready for modeling.
     """
-    covars = (
-        df[["amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1"]]
-        .apply(pd.to_numeric, errors="coerce")
-        .copy()
-    )
+    covars = df[["amalgam_surfaces", "RIDAGEYR"]].astype(np.float64)
     # Sex: 1=male, 2=female -> female indicator
-    covars["female"] = (covars.pop("RIAGENDR") == 2).astype(int)
+    covars["female"] = (df["RIAGENDR"] == 2).astype(np.int8)
     race_dummies = pd.get_dummies(
-        covars.pop("RIDRETH1").astype(int), prefix="race", drop_first=True
+        df["RIDRETH1"], prefix="race", drop_first=True, dtype=np.int8
     )
-    covars = pd.concat([covars, race_dummies], axis=1)
-    return covars.apply(pd.to_numeric, errors="coerce")
+    return pd.concat([covars, race_dummies], axis=1)
 
 
-def fit_cubic_spline(
-    df: pd.DataFrame, marker: str
-) -> sm.regression.linear_model.RegressionResultsWrapper:
-    """Fit OLS with a cubic spline for time."""
-    cols = ["time", marker, "amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1"]
-    data = df[cols].apply(pd.to_numeric, errors="coerce").dropna()
-    y = data[marker].astype(float)
-    covars = _encode_covariates(data)
-    time_spline = dmatrix(
-        "bs(time, degree=3, df=4, include_intercept=False)",
-        {"time": data["time"]},
-        return_type="dataframe",
+def fit_ols_columns(
+    X: pd.DataFrame, Y: pd.DataFrame
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Fit an OLS regression of every column of ``Y`` on ``X`` at once.
+
+    Each response uses the rows where it is observed. Responses with the same
+    missing-value pattern share one pseudo-inverse of their design rows, so the
+    estimates match ``sm.OLS(y, X).fit()`` run column by column.
+
+    Returns
+    -------
+    Coefficients and two-sided p-values, one row per column of ``Y``.
+    """
+    x = X.to_numpy(dtype=np.float64)
+    y = Y.to_numpy(dtype=np.float64)
+    params = np.full((y.shape[1], x.shape[1]), np.nan)
+    pvalues = np.full_like(params, np.nan)
+    masks, group = np.unique(~np.isnan(y), axis=1, return_inverse=True)
+    group = group.ravel()
+    for g in range(masks.shape[1]):
+        rows = masks[:, g]
+        if not rows.any():
+            continue
+        cols = np.flatnonzero(group == g)
+        xs = x[rows]
+        ys = y[np.ix_(rows, cols)]
+        pinv_x = np.linalg.pinv(xs, rcond=1e-15)
+        beta = pinv_x @ ys
+        df_resid = len(xs) - np.linalg.matrix_rank(xs)
+        sigma2 = ((ys - xs @ beta) ** 2).sum(axis=0) / df_resid
+        # diag of (X'X)^-1 is the row-wise sum of squares of pinv(X)
+        bse = np.sqrt(np.outer((pinv_x**2).sum(axis=1), sigma2))
+        params[cols] = beta.T
+        pvalues[cols] = 2 * stats.t.sf(np.abs(beta / bse), df_resid).T
+    return (
+        pd.DataFrame(params, index=Y.columns, columns=X.columns),
+        pd.DataFrame(pvalues, index=Y.columns, columns=X.columns),
     )
-    X = pd.concat([time_spline, covars], axis=1).astype(float)
-    X = sm.add_constant(X)
-    model = sm.OLS(y, X).fit()
-    return model
 
 
+def fit_cubic_splines(
+    data: pd.DataFrame, covars: pd.DataFrame, markers: list[str]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Fit the cubic spline OLS model of every marker on ``time`` and ``covars``.
+
+    As in a single-marker fit, the spline knots and bounds come from the rows
+    where the marker is observed. Markers with the same missing-value pattern
+    share that basis and one :func:`fit_ols_columns` solve.
+
+    Returns
+    -------
+    Coefficients and two-sided p-values, one row per marker.
+    """
+    observed = data[markers].notna().to_numpy()
+    masks, group = np.unique(observed, axis=1, return_inverse=True)
+    group = group.ravel()
+    coeffs, pvals = [], []
+    for g in range(masks.shape[1]):
+        rows = masks[:, g]
+        if not rows.any():
+            continue
+        cols = [markers[i] for i in np.flatnonzero(group == g)]
+        time_spline = dmatrix(
+            "bs(time, degree=3, df=4, include_intercept=False)",
+            {"time": data["time"][rows]},
+            return_type="dataframe",
+        )
+        X = pd.concat([time_spline, covars[rows]], axis=1).astype(float)
+        X = sm.add_constant(X)
+        params, pvalues = fit_ols_columns(X, data.loc[rows, cols])
+        coeffs.append(params)
+        pvals.append(pvalues)
+    return pd.concat(coeffs).reindex(markers), pd.concat(pvals).reindex(markers)
+
 
 def fit_logistic(
-    df: pd.DataFrame, marker: str
+    data: pd.DataFrame, covars: pd.DataFrame, marker: str
 ) -> sm.discrete.discrete_model.BinaryResultsWrapper | None:
     """Fit logistic regression with marker dichotomized at its median.
 
+    ``data`` and ``covars`` are the covariate-complete rows and their encoded
+    covariates; the fit uses the rows where ``marker`` is observed.
+
     Returns ``None`` if the model fails to converge.
     """
-    cols = ["time", marker, "amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1"]
-    data = df[cols].apply(pd.to_numeric, errors="coerce").dropna()
-    if data.empty:
+    rows = data[marker].notna().to_numpy()
+    if not rows.any():
         return None
-    median = data[marker].median()
-    data["binary"] = (data[marker] > median).astype(int)
-    covars = _encode_covariates(data)
-    covars["time"] = data["time"]
-    X = sm.add_constant(covars.astype(float))
+    y = data[marker][rows]
+    binary = (y > y.median()).astype(int)
+    X = covars[rows].assign(time=data["time"][rows])
+    X = sm.add_constant(X.astype(float))
     try:
-        model = sm.Logit(data["binary"], X).fit(disp=False)
+        model = sm.Logit(binary, X).fit(
+            method="newton", tol=1e-6, maxiter=25, disp=False
+        )
     except Exception as exc:  # pragma: no cover - handle convergence issues
         print(f"Logistic regression failed for {marker}: {exc}")
         return None
@@ -85,28 +158,36 @@ def fit_logistic(
 def run_models() -> None:
     """Run regression models for each marker and save results to CSV files."""
     df, _ = process_cycles()
+    df = df.astype(MODEL_DTYPES)
     # Approximate a time variable from the survey cycle start year
-    df = df.assign(time=df["Cycle"].str.slice(0, 4).astype(int)).copy()
+    df = df.assign(time=cycle_start_year(df["Cycle"]))
+
+    cols = ["time", "amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1"]
+    data = df[cols + MARKERS].dropna(subset=cols)
+    covars = _encode_covariates(data)
+    cubic_coeffs, cubic_pvals = fit_cubic_splines(data, covars, MARKERS)
 
-    cubic_coeffs: dict[str, pd.Series] = {}
-    cubic_pvals: dict[str, pd.Series] = {}
     log_coeffs: dict[str, pd.Series] = {}
     log_pvals: dict[str, pd.Series] = {}
 
     for marker in MARKERS:
-        cubic_model = fit_cubic_spline(df, marker)
-        cubic_coeffs[marker] = cubic_model.params
-        cubic_pvals[marker] = cubic_model.pvalues
-
-        log_model = fit_logistic(df, marker)
+        log_model = fit_logistic(data, covars, marker)
         if log_model is not None:
             log_coeffs[marker] = log_model.params
             log_pvals[marker] = log_model.pvalues
 
-    pd.DataFrame(cubic_coeffs).T.to_csv("cubic_spline_coeffs.csv")
-    pd.DataFrame(cubic_pvals).T.to_csv("cubic_spline_pvalues.csv")
-    pd.DataFrame(log_coeffs).T.to_csv("logistic_coeffs.csv")
-    pd.DataFrame(log_pvals).T.to_csv("logistic_pvalues.csv")
+    tables = {
+        "cubic_spline_coeffs": cubic_coeffs,
+        "cubic_spline_pvalues": cubic_pvals,
+        "logistic_coeffs": pd.DataFrame(log_coeffs).T,
+        "logistic_pvalues": pd.DataFrame(log_pvals).T,
+    }
+    for name, table in tables.items():
+        table.to_csv(f"{name}.csv")
+    # The same tables as one typed file for programmatic use
+    pd.concat(tables, names=["Table", "Marker"]).to_parquet(
+        "models.parquet", compression="zstd"
+    )
 
 
 if __name__ == "__main__":
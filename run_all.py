@@ -0,0 +1,22 @@
+"""Run the drinking and smoking analyses side by side."""
+
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+
+import drinker_analysis
+import smoker_analysis
+from descriptive_stats import process_cycles
+
+
+def main() -> None:
+    # Parse the XPT files once up front so both analyses read the Parquet cache
+    process_cycles()
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(drinker_analysis.main), pool.submit(smoker_analysis.main)]
+        for future in futures:
+            future.result()
+
+
+if __name__ == "__main__":
+    main()
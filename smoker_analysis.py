@@ -1,16 +1,22 @@
 from __future__ import annotations
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import pyreadstat
-from scipy.stats import ttest_ind
 import statsmodels.api as sm
-from patsy import dmatrix
 
+from analysis import nan_column_stats, welch_ttest
+from regression_models import MODEL_DTYPES, cycle_start_year, fit_cubic_splines
 from descriptive_stats import (
+    CACHE_DIR,
+    is_cache_fresh,
     process_cycles,
-    categorize_amalgam,
-    weighted_stats,
+    categorize_amalgam_vec,
+    grouped_weighted_stats,
+    write_cache,
 )
 
 # Mapping of survey cycles to Smoking Questionnaire files
@@ -25,62 +31,97 @@ SMOKING_FILES = {
     "2017-2018": "SMQ_J.xpt",
 }
 
+SMOKING_CYCLES = pd.CategoricalDtype(list(SMOKING_FILES))
+
 REQUIRED_LABELS = ["CBC", "Demographics", "Dental", "CRP", "Mercury", "Smoking"]
 
+# Alphabetical, so the reference level of the smoking dummies is unchanged
+SMOKING_STATUSES = [
+    "Current daily smoker",
+    "Current non-daily smoker",
+    "Former smoker",
+    "Never smoker",
+]
+
 
-def cycles_with_smoking(log_path: str = "download_log.csv") -> set[str]:
+@lru_cache(maxsize=4)
+def cycles_with_smoking(log_path: str = "download_log.csv") -> frozenset[str]:
     """Return cycles with all required files including smoking questionnaire."""
     if not os.path.exists(log_path):
         alt = os.path.join("national_stats", "download_log.csv")
         if os.path.exists(alt):
             log_path = alt
         else:
-            return set(SMOKING_FILES.keys())
+            return frozenset(SMOKING_FILES)
     log_df = pd.read_csv(log_path)
-    valid: set[str] = set()
-    for cycle, grp in log_df.groupby("Cycle"):
-        statuses = {lbl: grp[grp["Label"] == lbl]["Status"].iloc[0] for lbl in grp["Label"].unique()}
-        if all(statuses.get(lbl) == "success" for lbl in REQUIRED_LABELS):
-            valid.add(cycle)
-    return valid
-
-
-def load_smoking(data_dir: str, cycles: set[str]) -> pd.DataFrame:
-    """Load SMQ020 and SMQ040 for the given cycles."""
-    frames = []
-    for cycle in cycles:
-        fname = SMOKING_FILES.get(cycle)
-        if not fname:
-            continue
-        fpath = os.path.join(data_dir, fname)
-        if not os.path.exists(fpath):
-            continue
-        smq, _ = pyreadstat.read_xport(fpath)
-        cols = [c for c in ["SEQN", "SMQ020", "SMQ040"] if c in smq.columns]
-        smq = smq[cols]
-        smq["Cycle"] = cycle
-        frames.append(smq)
+    # Cycle x Label table of the first logged status of each file
+    status = log_df.drop_duplicates(["Cycle", "Label"]).pivot(
+        index="Cycle", columns="Label", values="Status"
+    )
+    complete = (status.reindex(columns=REQUIRED_LABELS) == "success").all(axis=1)
+    return frozenset(status.index[complete])
+
+
+def _read_one(cycle: str, fpath: str) -> pd.DataFrame:
+    """Read the questionnaire columns of one cycle with compact dtypes."""
+    smq, _ = pyreadstat.read_xport(fpath, usecols=["SEQN", "SMQ020", "SMQ040"])
+    # Answer codes are exact in float32; missing answers rule out int dtypes
+    out = smq.drop(columns="SEQN").astype(np.float32)
+    out.insert(0, "SEQN", smq["SEQN"].astype(np.int32))
+    out["Cycle"] = pd.Series(cycle, index=out.index, dtype=SMOKING_CYCLES)
+    return out
+
+
+def load_smoking(data_dir: str, cycles: frozenset[str]) -> pd.DataFrame:
+    """Load SMQ020 and SMQ040 for the given cycles.
+
+    The stacked result is cached as Parquet, keyed on the set of files read.
+    """
+    paths = {
+        cycle: os.path.join(data_dir, SMOKING_FILES[cycle])
+        for cycle in sorted(cycles)
+        if cycle in SMOKING_FILES and os.path.exists(os.path.join(data_dir, SMOKING_FILES[cycle]))
+    }
+    key = hashlib.md5(",".join(paths).encode()).hexdigest()[:12]
+    cache_path = os.path.join(data_dir, CACHE_DIR, f"smoking_{key}.parquet")
+    if paths and is_cache_fresh(cache_path, list(paths.values())):
+        return pd.read_parquet(cache_path)
+    frames: list[pd.DataFrame] = []
+    if paths:
+        # pyreadstat releases the GIL while parsing, so threads overlap the reads
+        with ThreadPoolExecutor(max_workers=min(8, len(paths))) as pool:
+            frames = list(pool.map(_read_one, paths, paths.values()))
     if frames:
-        return pd.concat(frames, ignore_index=True)
-    return pd.DataFrame(columns=["SEQN", "SMQ020", "SMQ040", "Cycle"])
+        smq = pd.concat(frames, ignore_index=True)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_cache(smq, cache_path)
+        return smq
+    return pd.DataFrame({
+        "SEQN": pd.Series(dtype=np.int32),
+        "SMQ020": pd.Series(dtype=np.float32),
+        "SMQ040": pd.Series(dtype=np.float32),
+        "Cycle": pd.Series(dtype=SMOKING_CYCLES),
+    })
 
 
 def classify_smoking(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    def _classify(row):
-        if row.get("SMQ020") == 2:
-            return "Never smoker"
-        if row.get("SMQ020") == 1:
-            if row.get("SMQ040") == 1:
-                return "Current daily smoker"
-            if row.get("SMQ040") == 2:
-                return "Current non-daily smoker"
-            if row.get("SMQ040") == 3:
-                return "Former smoker"
-        return np.nan
-    df["SmokingStatus"] = df.apply(_classify, axis=1)
-    df["Amalgam Group"] = df["amalgam_surfaces"].apply(categorize_amalgam)
-    return df
+    smq = df.reindex(columns=["SMQ020", "SMQ040"]).to_numpy(dtype=np.float64)
+    smq020, smq040 = smq[:, 0], smq[:, 1]
+    ever = smq020 == 1
+    codes = np.select(
+        [
+            ever & (smq040 == 1),
+            ever & (smq040 == 2),
+            ever & (smq040 == 3),
+            smq020 == 2,
+        ],
+        [0, 1, 2, 3],
+        default=-1,
+    )
+    return df.assign(
+        SmokingStatus=pd.Categorical.from_codes(codes, categories=SMOKING_STATUSES),
+        **{"Amalgam Group": categorize_amalgam_vec(df["amalgam_surfaces"].to_numpy())},
+    )
 
 
 def process_with_smoking(data_dir: str = "nhanes_data") -> pd.DataFrame:
@@ -88,64 +129,64 @@ def process_with_smoking(data_dir: str = "nhanes_data") -> pd.DataFrame:
     if base_df.empty:
         return base_df
     valid_cycles = cycles_with_smoking()
-    base_df = base_df[base_df["Cycle"].isin(valid_cycles)].copy()
+    base_df = base_df[base_df["Cycle"].isin(valid_cycles)]
     smq_df = load_smoking(data_dir, valid_cycles)
-    combined = base_df.merge(smq_df, on=["SEQN", "Cycle"], how="left")
+    # Narrow, identically typed keys on both sides keep the hash join cheap;
+    # the model columns are cast here once so no fit has to coerce them
+    keys = {"SEQN": np.int32, "Cycle": pd.CategoricalDtype(sorted(valid_cycles))}
+    combined = base_df.astype({**keys, **MODEL_DTYPES}).merge(
+        smq_df.astype(keys),
+        on=["SEQN", "Cycle"],
+        how="left",
+        validate="m:1",
+        sort=False,
+    )
     combined = classify_smoking(combined)
     return combined
 
 
 def compute_smoking_descriptive(df: pd.DataFrame) -> pd.DataFrame:
     markers = ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]
-    results = []
-    for cycle, df_cycle in df.groupby("Cycle"):
-        for smoke, df_smoke in df_cycle.groupby("SmokingStatus"):
-            for amalgam, df_group in df_smoke.groupby("Amalgam Group"):
-                for marker in markers:
-                    sub = df_group[[marker, "WTMEC2YR"]].dropna()
-                    if sub.empty:
-                        continue
-                    m, sd, lo, hi = weighted_stats(sub[marker], sub["WTMEC2YR"])
-                    results.append({
-                        "Cycle": cycle,
-                        "SmokingStatus": smoke,
-                        "Amalgam Group": amalgam,
-                        "Marker": marker,
-                        "Mean": m,
-                        "SD": sd,
-                        "CI_Low": lo,
-                        "CI_High": hi,
-                        "Sample Size": len(sub),
-                    })
-    return pd.DataFrame(results)
+    stats = grouped_weighted_stats(df, ["Cycle", "SmokingStatus", "Amalgam Group"], markers)
+    # Amalgam groups in alphabetical order, as the former string groupby wrote them
+    return stats.sort_values(
+        ["Cycle", "SmokingStatus", "Amalgam Group"],
+        key=lambda col: col.astype(str) if col.name == "Amalgam Group" else col,
+        kind="stable",
+        ignore_index=True,
+    )
 
 
 def run_smoking_ttests(df: pd.DataFrame) -> pd.DataFrame:
     markers = ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]
     comparisons = [("None", "Low"), ("None", "Medium"), ("None", "High")]
     results = []
-    for cycle, df_cycle in df.groupby("Cycle"):
-        for smoke, df_smoke in df_cycle.groupby("SmokingStatus"):
-            for var1, var2 in comparisons:
-                g1 = df_smoke[df_smoke["Amalgam Group"] == var1]
-                g2 = df_smoke[df_smoke["Amalgam Group"] == var2]
-                for marker in markers:
-                    g1_vals = g1[marker].dropna()
-                    g2_vals = g2[marker].dropna()
-                    if len(g1_vals) < 10 or len(g2_vals) < 10:
-                        continue
-                    stat, pval = ttest_ind(g1_vals, g2_vals, equal_var=False)
-                    results.append({
-                        "Cycle": cycle,
-                        "SmokingStatus": smoke,
-                        "Marker": marker,
-                        "Comparison": f"{var1} vs {var2}",
-                        "Group1 n": len(g1_vals),
-                        "Group2 n": len(g2_vals),
-                        "t-stat": round(stat, 3),
-                        "p-value": round(pval, 5),
-                        "Significant": pval < 0.05,
-                    })
+    for (cycle, smoke), df_smoke in df.groupby(["Cycle", "SmokingStatus"], observed=True):
+        # (rows x markers) array plus the row positions of each amalgam group,
+        # so every comparison slices arrays instead of re-filtering the frame
+        values = df_smoke[markers].to_numpy(dtype=np.float64)
+        rows = df_smoke.groupby("Amalgam Group", observed=True).indices
+        for var1, var2 in comparisons:
+            if var1 not in rows or var2 not in rows:
+                continue
+            n1, m1, v1 = nan_column_stats(values[rows[var1]])
+            n2, m2, v2 = nan_column_stats(values[rows[var2]])
+            keep = (n1 >= 10) & (n2 >= 10)
+            if not keep.any():
+                continue
+            stat, pval = welch_ttest(n1[keep], m1[keep], v1[keep], n2[keep], m2[keep], v2[keep])
+            for k, i in enumerate(np.flatnonzero(keep)):
+                results.append({
+                    "Cycle": cycle,
+                    "SmokingStatus": smoke,
+                    "Marker": markers[i],
+                    "Comparison": f"{var1} vs {var2}",
+                    "Group1 n": int(n1[i]),
+                    "Group2 n": int(n2[i]),
+                    "t-stat": round(stat[k], 3),
+                    "p-value": round(pval[k], 5),
+                    "Significant": pval[k] < 0.05,
+                })
     return pd.DataFrame(results)
 
 
@@ -154,60 +195,72 @@ MARKERS = ["NLR", "MLR", "PLR", "SII", "CRP", "BloodMercury"]
 
 
 def _encode_covariates(df: pd.DataFrame) -> pd.DataFrame:
-    covars = df[["amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "SmokingStatus"]].copy()
-    covars = covars.apply(pd.to_numeric, errors="ignore")
-    covars["female"] = (covars.pop("RIAGENDR") == 2).astype(int)
-    race_dummies = pd.get_dummies(covars.pop("RIDRETH1").astype(int), prefix="race", drop_first=True)
-    smoke_dummies = pd.get_dummies(covars.pop("SmokingStatus"), prefix="smoke", drop_first=True)
-    covars = pd.concat([covars, race_dummies, smoke_dummies], axis=1)
-    return covars.apply(pd.to_numeric, errors="coerce")
-
-
-def fit_cubic_spline(df: pd.DataFrame, marker: str) -> sm.regression.linear_model.RegressionResultsWrapper:
-    cols = ["time", marker, "amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "SmokingStatus"]
-    data = df[cols].apply(pd.to_numeric, errors="ignore").dropna()
-    y = data[marker].astype(float)
-    covars = _encode_covariates(data)
-    time_spline = dmatrix("bs(time, degree=3, df=4, include_intercept=False)", {"time": data["time"]}, return_type="dataframe")
-    X = pd.concat([time_spline, covars], axis=1).astype(float)
-    X = sm.add_constant(X)
-    return sm.OLS(y, X).fit()
-
-
-def fit_logistic(df: pd.DataFrame, marker: str) -> sm.discrete.discrete_model.BinaryResultsWrapper | None:
-    cols = ["time", marker, "amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "SmokingStatus"]
-    data = df[cols].apply(pd.to_numeric, errors="ignore").dropna()
-    if data.empty:
+    columns = {
+        "amalgam_surfaces": df["amalgam_surfaces"].to_numpy(dtype=np.float64),
+        "RIDAGEYR": df["RIDAGEYR"].to_numpy(dtype=np.float64),
+        "female": (df["RIAGENDR"].to_numpy() == 2).astype(np.int8),
+    }
+    # Same columns as get_dummies(..., drop_first=True), built in one frame
+    race = df["RIDRETH1"].to_numpy().astype(np.int8)
+    for level in np.unique(race)[1:]:
+        columns[f"race_{level}"] = (race == level).astype(np.int8)
+    # Only observed statuses get a column, as get_dummies on the labels did
+    smoke = df["SmokingStatus"].cat.remove_unused_categories()
+    for status in smoke.cat.categories[1:]:
+        columns[f"smoke_{status}"] = (smoke == status).to_numpy().astype(np.int8)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _design_matrices(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Return the covariate-complete rows and their encoded covariates.
+
+    Neither depends on the marker, so both are built once per dataset and
+    each fit selects the rows where its marker is observed.
+    """
+    cols = ["time", "amalgam_surfaces", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "SmokingStatus"]
+    data = df[cols + MARKERS].dropna(subset=cols)
+    return data, _encode_covariates(data)
+
+
+def fit_logistic(
+    data: pd.DataFrame, covars: pd.DataFrame, marker: str
+) -> sm.discrete.discrete_model.BinaryResultsWrapper | None:
+    rows = data[marker].notna().to_numpy()
+    if not rows.any():
         return None
-    median = data[marker].median()
-    data["binary"] = (data[marker] > median).astype(int)
-    covars = _encode_covariates(data)
-    covars["time"] = data["time"]
-    X = sm.add_constant(covars.astype(float))
+    y = data[marker][rows]
+    binary = (y > y.median()).astype(int)
+    X = covars[rows].assign(time=data["time"][rows])
+    X = sm.add_constant(X.astype(float))
     try:
-        return sm.Logit(data["binary"], X).fit(disp=False)
+        return sm.Logit(binary, X).fit(method="newton", tol=1e-6, maxiter=25, disp=False)
     except Exception:
         return None
 
 
 def run_models(df: pd.DataFrame, out_dir: str) -> None:
-    df = df.assign(time=df["Cycle"].str.slice(0, 4).astype(int)).copy()
-    cubic_coeffs: dict[str, pd.Series] = {}
-    cubic_pvals: dict[str, pd.Series] = {}
+    df = df.assign(time=cycle_start_year(df["Cycle"]))
+    data, covars = _design_matrices(df)
+    cubic_coeffs, cubic_pvals = fit_cubic_splines(data, covars, MARKERS)
     log_coeffs: dict[str, pd.Series] = {}
     log_pvals: dict[str, pd.Series] = {}
     for marker in MARKERS:
-        c_model = fit_cubic_spline(df, marker)
-        cubic_coeffs[marker] = c_model.params
-        cubic_pvals[marker] = c_model.pvalues
-        l_model = fit_logistic(df, marker)
+        l_model = fit_logistic(data, covars, marker)
         if l_model is not None:
             log_coeffs[marker] = l_model.params
             log_pvals[marker] = l_model.pvalues
-    pd.DataFrame(cubic_coeffs).T.to_csv(os.path.join(out_dir, "smoke_cubic_spline_coeffs.csv"))
-    pd.DataFrame(cubic_pvals).T.to_csv(os.path.join(out_dir, "smoke_cubic_spline_pvalues.csv"))
-    pd.DataFrame(log_coeffs).T.to_csv(os.path.join(out_dir, "smoke_logistic_coeffs.csv"))
-    pd.DataFrame(log_pvals).T.to_csv(os.path.join(out_dir, "smoke_logistic_pvalues.csv"))
+    tables = {
+        "cubic_spline_coeffs": cubic_coeffs,
+        "cubic_spline_pvalues": cubic_pvals,
+        "logistic_coeffs": pd.DataFrame(log_coeffs).T,
+        "logistic_pvalues": pd.DataFrame(log_pvals).T,
+    }
+    for name, table in tables.items():
+        table.to_csv(os.path.join(out_dir, f"smoke_{name}.csv"))
+    # The same tables as one typed file for programmatic use
+    pd.concat(tables, names=["Table", "Marker"]).to_parquet(
+        os.path.join(out_dir, "smoke_models.parquet"), compression="zstd"
+    )
 
 
 def main() -> None: